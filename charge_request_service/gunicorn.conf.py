@@ -0,0 +1,29 @@
+# Gunicorn settings for the charge request service.
+# The service keeps no state between requests, so it scales across worker processes;
+# Prometheus metrics are aggregated through PROMETHEUS_MULTIPROC_DIR (set in the Dockerfile).
+import glob
+import multiprocessing
+import os
+
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+
+bind = '0.0.0.0:5001'
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+# Hold idle client connections open between bursts instead of gunicorn's default 2s
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '75'))
+
+
+def on_starting(server):
+    # Metric files left by a previous run (e.g. after a container restart) would be
+    # summed into /metrics, so the directory must be emptied before workers start
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
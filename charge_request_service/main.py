@@ -1,22 +1,59 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import orjson
+import uuid
+import datetime
+import os
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
 
 app = Flask(__name__)
-metrics = PrometheusMetrics(app)
+# Under multi-worker gunicorn, aggregate metrics across workers through the multiprocess directory
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def ojsonify(obj, status=200):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC), status=status,
+                              mimetype='application/json')
+
+
+def passthrough(response):
+    """Relay an upstream JSON response body and status code without re-parsing it"""
+    return app.response_class(response.content, status=response.status_code, mimetype='application/json')
+
+
 # Configuration
 LOAD_BALANCER_URL = "http://load_balancer:5002"
 
+_utcnow = datetime.datetime.utcnow
+
+# Fields every charge request must carry, in the order they are reported when missing
+REQUIRED_FIELDS = ('vehicle_id', 'requested_power', 'duration')
+_REQUIRED = frozenset(REQUIRED_FIELDS)
+
+# Shared HTTP session so keep-alive connections to the load balancer are reused
+session = requests.Session()
+session.mount('http://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+))
+
 @app.route('/health', methods=['GET'])
 def health_check():
     
-    return jsonify({"status": "healthy", "service": "charge_request_service"}), 200
+    return ojsonify({"status": "healthy", "service": "charge_request_service"}, 200)
 
 @app.route('/api/charge', methods=['POST'])
 def request_charge():
@@ -25,84 +62,90 @@ def request_charge():
         # Get request data
         data = request.get_json()
         if not data:
-            return jsonify({"error": "No data provided"}), 400
+            return ojsonify({"error": "No data provided"}, 400)
+        if not isinstance(data, dict):
+            return ojsonify({"error": "Request body must be a JSON object"}, 400)
 
         # Validate required fields
-        required_fields = ['vehicle_id', 'requested_power', 'duration']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({"error": f"Missing required field: {field}"}), 400
+        missing = _REQUIRED - data.keys()
+        if missing:
+            field = next(field for field in REQUIRED_FIELDS if field in missing)
+            return ojsonify({"error": f"Missing required field: {field}"}, 400)
+        for field in ('requested_power', 'duration'):
+            value = data[field]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return ojsonify({"error": f"Invalid value for field: {field}"}, 400)
 
         # Add timestamp and request ID
-        import uuid
-        import datetime
-        data['request_id'] = str(uuid.uuid4())
-        data['timestamp'] = datetime.datetime.utcnow().isoformat()
+        data['request_id'] = uuid.uuid4().hex
+        data['timestamp'] = _utcnow().isoformat()
 
         logger.info(f"Received charging request: {data['request_id']} for vehicle {data['vehicle_id']}")
 
         # Forward request to load balancer
         try:
-            response = requests.post(
+            response = session.post(
                 f"{LOAD_BALANCER_URL}/api/assign-substation",
                 json=data,
                 timeout=30
             )
-            response.raise_for_status()
-
-            result = response.json()
-            logger.info(f"Request {data['request_id']} assigned to substation {result.get('substation_id')}")
-
-            return jsonify({
+            logger.info(f"Request {data['request_id']} forwarded to load balancer ({response.status_code})")
+            if not response.ok:
+                # Relay the load balancer's status and error body, tagged with the request_id
+                upstream_is_json = response.headers.get('Content-Type', '').startswith('application/json')
+                return ojsonify({
+                    "error": "Charging request could not be assigned",
+                    "request_id": data['request_id'],
+                    "details": orjson.Fragment(response.content) if upstream_is_json else None
+                }, response.status_code)
+
+            # Embed the assignment bytes as-is instead of parsing and re-serializing them
+            return ojsonify({
                 "status": "accepted",
                 "request_id": data['request_id'],
                 "message": "Charging request submitted successfully",
-                "assignment": result
-            }), 200
+                "assignment": orjson.Fragment(response.content)
+            }, 200)
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to communicate with load balancer: {str(e)}")
-            return jsonify({
+            return ojsonify({
                 "error": "Service temporarily unavailable",
                 "request_id": data['request_id']
-            }), 503
+            }, 503)
 
     except Exception as e:
         logger.error(f"Error processing charge request: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
 
 @app.route('/api/status/<request_id>', methods=['GET'])
 def get_charge_status(request_id):
     
     try:
         # Forward request to load balancer
-        response = requests.get(
+        response = session.get(
             f"{LOAD_BALANCER_URL}/api/status/{request_id}",
             timeout=30
         )
-        response.raise_for_status()
-
-        return response.json(), response.status_code
+        return passthrough(response)
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to get status for request {request_id}: {str(e)}")
-        return jsonify({"error": "Unable to retrieve status"}), 503
+        return ojsonify({"error": "Unable to retrieve status"}, 503)
 
 @app.route('/api/requests', methods=['GET'])
 def list_requests():
     
     try:
-        response = requests.get(
+        response = session.get(
             f"{LOAD_BALANCER_URL}/api/requests",
             timeout=30
         )
-        response.raise_for_status()
-
-        return response.json(), response.status_code
+        return passthrough(response)
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to list requests: {str(e)}")
-        return jsonify({"error": "Unable to retrieve requests"}), 503
+        return ojsonify({"error": "Unable to retrieve requests"}, 503)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001)
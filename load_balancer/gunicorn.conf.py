@@ -0,0 +1,10 @@
+# Gunicorn settings for the load balancer.
+# Substation snapshots, active requests and the monitor thread live in process memory,
+# so the service runs as a single worker and gets its concurrency from threads.
+# preload_app stays off: the monitor thread would not survive the fork into the worker.
+import os
+
+bind = '0.0.0.0:5002'
+worker_class = 'gthread'
+workers = 1
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
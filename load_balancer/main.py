@@ -1,13 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 import time
+import heapq
+import itertools
+from collections import deque, OrderedDict
+import hashlib
+import orjson
+import msgspec
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
 from prometheus_flask_exporter import PrometheusMetrics
 from prometheus_client import Gauge, Counter, Histogram
 import os
 from urllib.parse import urlparse
 from datetime import datetime, timezone
+from types import MappingProxyType
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
@@ -16,6 +26,12 @@ metrics = PrometheusMetrics(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def ojsonify(obj, status=200):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC), status=status,
+                              mimetype='application/json')
+
 # Custom Prometheus metrics
 load_balancer_requests = Counter('load_balancer_requests_total', 'Total requests to load balancer',
                                  ['endpoint', 'status'])
@@ -23,17 +39,70 @@ substation_assignment_time = Histogram('substation_assignment_duration_seconds',
                                        'Time spent assigning requests to substations')
 active_requests_gauge = Gauge('load_balancer_active_requests', 'Number of active charging requests')
 
+class SubstationStatus(msgspec.Struct, frozen=True):
+    """Body of a substation's /status response"""
+    substation_id: str
+    current_load: float
+    max_capacity: float
+    utilization_percent: float
+    available_capacity: float
+    active_sessions: int
+
+
+_status_decoder = msgspec.json.Decoder(SubstationStatus)
+
+# Number of completed requests retained for status lookups
+REQUEST_HISTORY_SIZE = 1024
+
+# Number of completions retained for requests whose assignment has not been recorded yet
+EARLY_COMPLETION_SIZE = 1024
+
+# Shared HTTP session so keep-alive connections to the substations are reused.
+# It only carries /charge calls, so the pool is sized for the request-handling threads.
+session = requests.Session()
+session.mount('http://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+))
+
+# Status probes get their own small pool so they never queue behind, or evict,
+# connections held by in-flight /charge calls. A failed probe is simply retried
+# on the next monitor tick.
+probe_session = requests.Session()
+probe_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=2, max_retries=0))
+
 
 class LoadBalancer:
     def __init__(self):
-        self.substations = {}
+        # Read-only substation table, replaced wholesale by the monitor thread after
+        # every poll. Readers grab the reference once and need no lock.
+        self._snapshot = MappingProxyType({})
         self.active_requests = {}
-        self.request_history = []
+        self.request_history = deque(maxlen=REQUEST_HISTORY_SIZE)
+        self._completed_by_id = OrderedDict()
+        # Completion callbacks that arrived before assign_request recorded the request,
+        # applied once it does: request_id -> session data
+        self._early_completions = OrderedDict()
+        # Guards active requests, request history and the selection heap
         self.lock = threading.Lock()
 
+        # Min-heap of (current_load, substation_id) over healthy substations, plus the
+        # load each substation is assumed to carry, including assignments made since
+        # the last poll. Entries are invalidated lazily once their load is outdated.
+        self._heap = []
+        self._loads = {}
+
+        # Serialized /api/system-status body: (expires_at, body_bytes, etag)
+        self._status_cache = (0.0, None, None)
+
         # Load substation URLs from environment or use defaults
         self.substation_urls = self._get_substation_urls()
 
+        # Probe all substations concurrently so one slow node doesn't delay the rest
+        self._probe_pool = ThreadPoolExecutor(max_workers=max(4, len(self.substation_urls)),
+                                              thread_name_prefix='substation-probe')
+
         # Start monitoring thread
         self.monitoring_thread = threading.Thread(target=self._monitor_substations, daemon=True)
         self.monitoring_thread.start()
@@ -62,63 +131,125 @@ class LoadBalancer:
         
         while True:
             try:
-                for url in self.substation_urls:
-                    self._update_substation_status(url)
+                self._refresh_snapshot()
                 time.sleep(5)  # Update every 5 seconds
             except Exception as e:
                 logger.error(f"Error in monitoring thread: {e}")
                 time.sleep(5)
 
-    def _update_substation_status(self, url):
+    def _refresh_snapshot(self):
+        futures = {self._probe_pool.submit(self._probe_substation, url): url
+                   for url in self.substation_urls}
+        done, _ = wait(futures, timeout=4.5)
+
+        previous = self._snapshot
+        previous_by_url = {info['url']: (substation_id, info) for substation_id, info in previous.items()}
+        substations = {}
+        for future, url in futures.items():
+            status = None
+            if future in done:
+                if future.exception():
+                    logger.error(f"Error probing substation {url}: {future.exception()}")
+                else:
+                    status = future.result()
+            if status is not None:
+                substations[status.substation_id] = {
+                    'url': url,
+                    'status': status,
+                    'last_updated': time.time(),
+                    'healthy': True
+                }
+            elif url in previous_by_url:
+                substation_id, info = previous_by_url[url]
+                substations[substation_id] = dict(info, healthy=False)
+
+        self._publish_snapshot(previous, substations)
+
+    def _probe_substation(self, url):
         
         try:
-            response = requests.get(f"{url}/status", timeout=5)
+            response = probe_session.get(f"{url}/status", timeout=4)
             if response.status_code == 200:
-                status = response.json()
-                substation_id = status['substation_id']
-
-                # with self.lock:
-                self.substations[substation_id] = {
-                        'url': url,
-                        'status': status,
-                        'last_updated': time.time(),
-                        'healthy': True
-                    }
-            else:
-                self._mark_substation_unhealthy(url)
-
-        except requests.exceptions.RequestException as e:
+                return _status_decoder.decode(response.content)
+        except (requests.exceptions.RequestException, msgspec.DecodeError) as e:
             logger.warning(f"Failed to get status from {url}: {e}")
-            self._mark_substation_unhealthy(url)
-
-    def _mark_substation_unhealthy(self, url):
-        
-        # with self.lock:
-        for substation_id, info in self.substations.items():
-                if info['url'] == url:
-                    info['healthy'] = False
-                    break
+        return None
+
+    def _publish_snapshot(self, previous, substations):
+        changed = previous.keys() != substations.keys() or any(
+            previous[substation_id]['healthy'] != info['healthy']
+            or previous[substation_id]['status'].current_load != info['status'].current_load
+            for substation_id, info in substations.items()
+        )
+        with self.lock:
+            self._snapshot = MappingProxyType(substations)
+            self._loads = {substation_id: info['status'].current_load
+                           for substation_id, info in substations.items() if info['healthy']}
+            self._rebuild_heap()
+        if changed:
+            self._invalidate_status_cache()
+
+    # The heap helpers below expect self.lock to be held by the caller
+
+    def _push_heap_entry(self, substation_id):
+        heapq.heappush(self._heap, (self._loads[substation_id], substation_id))
+        # Compact once stale entries outnumber live ones
+        if len(self._heap) > 2 * len(self._loads) + 16:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(current_load, substation_id) for substation_id, current_load in self._loads.items()]
+        heapq.heapify(self._heap)
+
+    def _is_current_entry(self, entry):
+        current_load, substation_id = entry
+        return self._loads.get(substation_id) == current_load
+
+    def _pop_eligible(self, requested_power):
+        snapshot = self._snapshot
+        popped = []
+        selected = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if not self._is_current_entry(entry):
+                continue
+            popped.append(entry)
+            current_load, substation_id = entry
+            if snapshot[substation_id]['status'].max_capacity - current_load >= requested_power:
+                selected = substation_id
+                break
+        # Live entries stay in the heap; only the post-assignment update replaces them
+        for entry in popped:
+            heapq.heappush(self._heap, entry)
+        return selected
 
     def _select_best_substation(self, requested_power):
-        # with self.lock:
-        eligible_substations = []
-        for substation_id, info in self.substations.items():
-            if not info['healthy']:
-                continue
-            status = info['status']
-            available_capacity = status['available_capacity']
-            if available_capacity >= requested_power:
-                eligible_substations.append({
-                    'substation_id': substation_id,
-                    'url': info['url'],
-                    'current_load': status['current_load'],
-                    'available_capacity': available_capacity,
-                    'utilization': status['utilization_percent']
-                })
-        if not eligible_substations:
-            return None
-        eligible_substations.sort(key=lambda x: x['current_load'])
-        return eligible_substations[0]
+        with self.lock:
+            # The heap holds a live entry for every healthy substation, so a miss
+            # here means none of them has room
+            substation_id = self._pop_eligible(requested_power)
+            if substation_id is None:
+                return None
+            info = self._snapshot[substation_id]
+            current_load = self._loads[substation_id]
+            max_capacity = info['status'].max_capacity
+            return {
+                'substation_id': substation_id,
+                'url': info['url'],
+                'current_load': current_load,
+                'available_capacity': max_capacity - current_load,
+                'utilization': (current_load / max_capacity) * 100
+            }
+
+    def _record_assignment(self, substation_id, requested_power):
+        # Account for the new session until the next status poll reports it
+        if substation_id not in self._loads:
+            return
+        self._loads[substation_id] += requested_power
+        self._push_heap_entry(substation_id)
+
+    def _invalidate_status_cache(self):
+        self._status_cache = (0.0, None, None)
 
     @substation_assignment_time.time()
     def assign_request(self, request_data):
@@ -135,23 +266,31 @@ class LoadBalancer:
                     'reason': 'All substations at capacity or unavailable'
                 }, 503
             try:
-                response = requests.post(
+                response = session.post(
                     f"{selected['url']}/charge",
                     json=request_data,
                     timeout=30
                 )
                 if response.status_code == 200:
-                    result = response.json()
-                    # with self.lock:
-                    self.active_requests[request_data['request_id']] = {
-                            'request_data': request_data,
-                            'substation_id': selected['substation_id'],
-                            'substation_url': selected['url'],
-                            'session_id': result.get('session_id'),
-                            'status': 'assigned',
-                            'assigned_at': time.time()
-                        }
-                    active_requests_gauge.set(len(self.active_requests))
+                    result = orjson.loads(response.content)
+                    req_info = {
+                        'request_data': request_data,
+                        'substation_id': selected['substation_id'],
+                        'substation_url': selected['url'],
+                        'session_id': result.get('session_id'),
+                        'status': 'assigned',
+                        'assigned_at': time.time()
+                    }
+                    with self.lock:
+                        self._record_assignment(selected['substation_id'], requested_power)
+                        if request_data['request_id'] in self._early_completions:
+                            # The session finished before this assignment was recorded
+                            self._finish_request(request_data['request_id'], req_info,
+                                                 self._early_completions.pop(request_data['request_id']))
+                        else:
+                            self.active_requests[request_data['request_id']] = req_info
+                        active_count = len(self.active_requests)
+                    active_requests_gauge.set(active_count)
                     load_balancer_requests.labels(endpoint='assign', status='success').inc()
                     return {
                         'status': 'assigned',
@@ -175,48 +314,70 @@ class LoadBalancer:
             return {'error': 'Internal server error'}, 500
 
     def get_request_status(self, request_id):
-        # with self.lock:
-        if request_id not in self.active_requests:
-            for req in self.request_history:
-                if req['request_data']['request_id'] == request_id:
-                    return {'status': 'completed', 'details': req}, 200
-            return {'error': 'Request not found'}, 404
-        req_info = self.active_requests[request_id]
-        try:
-            response = requests.get(
-                f"{req_info['substation_url']}/sessions/{req_info['session_id']}",
-                timeout=10
-            )
-            if response.status_code == 200:
-                session_data = response.json()
-                req_info['session_status'] = session_data
-                if session_data.get('status') == 'completed':
-                    self.request_history.append(req_info)
-                    del self.active_requests[request_id]
-                    active_requests_gauge.set(len(self.active_requests))
-                    return {'status': 'completed', 'details': req_info}, 200
-        except requests.exceptions.RequestException:
-            pass
-        return {'status': 'active', 'details': req_info}, 200
+        with self.lock:
+            req_info = self.active_requests.get(request_id)
+            if req_info is not None:
+                return {'status': 'active', 'details': req_info}, 200
+            req = self._completed_by_id.get(request_id)
+            if req is not None:
+                return {'status': 'completed', 'details': req}, 200
+        return {'error': 'Request not found'}, 404
+
+    def _finish_request(self, request_id, req_info, session_data):
+        # Called with self.lock held
+        req_info['session_status'] = session_data
+        self.request_history.append(req_info)
+        self._completed_by_id[request_id] = req_info
+        if len(self._completed_by_id) > REQUEST_HISTORY_SIZE:
+            self._completed_by_id.popitem(last=False)
+
+    def complete_request(self, request_id, session_data):
+        """Move a request to history once its substation reports the session completed
+
+        Returns False if the request is not known yet; the completion is then held
+        until assign_request records the request. Repeated callbacks are ignored.
+        """
+        with self.lock:
+            if request_id in self._completed_by_id:
+                return True
+            req_info = self.active_requests.pop(request_id, None)
+            if req_info is None:
+                self._early_completions[request_id] = session_data
+                if len(self._early_completions) > EARLY_COMPLETION_SIZE:
+                    self._early_completions.popitem(last=False)
+                return False
+            self._finish_request(request_id, req_info, session_data)
+            active_count = len(self.active_requests)
+        active_requests_gauge.set(active_count)
+        return True
 
     def get_all_requests(self):
         
-        # with self.lock:
-        return {
-            'active_requests': list(self.active_requests.values()),
-            'recent_completed': self.request_history[-20:],  # Last 20 completed
-            'total_active': len(self.active_requests)
-        }
+        with self.lock:
+            return {
+                'active_requests': list(self.active_requests.values()),
+                'recent_completed': list(itertools.islice(self.request_history,
+                                                          max(0, len(self.request_history) - 20), None)),  # Last 20 completed
+                'total_active': len(self.active_requests)
+            }
 
     def get_system_status(self):
-        
-        # with self.lock:
-        return {
-                'substations': self.substations,
-                'active_requests': len(self.active_requests),
-                'total_substations': len(self.substations),
-                'healthy_substations': sum(1 for info in self.substations.values() if info['healthy'])
-    }
+        """Return the serialized system status and its ETag, cached for one monitor period"""
+        expires_at, body, etag = self._status_cache
+        now = time.time()
+        if now < expires_at:
+            return body, etag
+
+        snapshot = self._snapshot
+        body = orjson.dumps({
+            'substations': dict(snapshot),
+            'active_requests': len(self.active_requests),
+            'total_substations': len(snapshot),
+            'healthy_substations': sum(1 for info in snapshot.values() if info['healthy'])
+        }, default=msgspec.to_builtins)
+        etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        self._status_cache = (now + 5, body, etag)
+        return body, etag
 
 
 # Initialize load balancer
@@ -225,7 +386,7 @@ load_balancer = LoadBalancer()
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "service": "load_balancer"}), 200
+    return ojsonify({"status": "healthy", "service": "load_balancer"}, 200)
 
 
 @app.route('/api/assign-substation', methods=['POST'])
@@ -233,50 +394,75 @@ def assign_substation():
     try:
         data = request.get_json()
         if not data:
-            return jsonify({"error": "No data provided"}), 400
+            return ojsonify({"error": "No data provided"}, 400)
         result, status_code = load_balancer.assign_request(data)
-        return jsonify(result), status_code
+        return ojsonify(result, status_code)
     except Exception as e:
         logger.error(f"Error in assign_substation: {e}")
         load_balancer_requests.labels(endpoint='assign', status='error').inc()
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
 
 
 @app.route('/api/status/<request_id>', methods=['GET'])
 def get_request_status(request_id):
     try:
         result, status_code = load_balancer.get_request_status(request_id)
-        return jsonify(result), status_code
+        return ojsonify(result, status_code)
     except Exception as e:
         logger.error(f"Error getting request status: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
+
+
+@app.route('/api/session-completed', methods=['POST'])
+def session_completed():
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict) or not data.get('request_id'):
+            return ojsonify({"error": "No request_id provided"}, 400)
+        if not load_balancer.complete_request(data['request_id'], data.get('session')):
+            # Accepted and held until the assignment is recorded
+            return ojsonify({"status": "pending", "request_id": data['request_id']}, 202)
+        return ojsonify({"status": "completed", "request_id": data['request_id']}, 200)
+    except Exception as e:
+        logger.error(f"Error recording session completion: {e}")
+        return ojsonify({"error": "Internal server error"}, 500)
 
 
 @app.route('/api/requests', methods=['GET'])
 def list_requests():
     try:
-        return jsonify(load_balancer.get_all_requests()), 200
+        return ojsonify(load_balancer.get_all_requests(), 200)
     except Exception as e:
         logger.error(f"Error listing requests: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
+
+
+def system_status_response():
+    body, etag = load_balancer.get_system_status()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/api/substations', methods=['GET'])
 def list_substations():
     try:
-        return jsonify(load_balancer.get_system_status()), 200
+        return system_status_response()
     except Exception as e:
         logger.error(f"Error listing substations: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
 
 
 @app.route('/api/system-status', methods=['GET'])
 def system_status():
     try:
-        return jsonify(load_balancer.get_system_status()), 200
+        return system_status_response()
     except Exception as e:
         logger.error(f"Error getting system status: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
 
 
 if __name__ == '__main__':
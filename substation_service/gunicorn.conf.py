@@ -0,0 +1,9 @@
+# Gunicorn settings for a substation.
+# Session state and the completion timer thread live in process memory,
+# so the service runs as a single worker and gets its concurrency from threads.
+import os
+
+bind = '0.0.0.0:5003'
+worker_class = 'gthread'
+workers = 1
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
@@ -1,13 +1,20 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 import time
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 import random
 import logging
+import orjson
 from prometheus_flask_exporter import PrometheusMetrics
 from prometheus_client import Gauge, Counter, Histogram
 import uuid
-import datetime
-from datetime import datetime, timezone
+import itertools
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta, timezone
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
@@ -16,6 +23,21 @@ metrics = PrometheusMetrics(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def ojsonify(obj, status=200):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC), status=status,
+                              mimetype='application/json')
+
+
+def format_session(session):
+    """Return a session dict for output, with epoch timestamps rendered as ISO 8601"""
+    formatted = {key: value for key, value in session.items() if key != 'start_monotonic'}
+    for key in ('start_time', 'end_time'):
+        if key in formatted:
+            formatted[key] = datetime.fromtimestamp(formatted[key], tz=timezone.utc).isoformat()
+    return formatted
+
 # Custom Prometheus metrics
 substation_load_gauge = Gauge('substation_current_load_kw', 'Current load of the substation in kW', ['substation_id'])
 substation_capacity_gauge = Gauge('substation_max_capacity_kw', 'Maximum capacity of the substation in kW',
@@ -25,89 +47,189 @@ charging_sessions_counter = Counter('charging_sessions_total', 'Total number of
 charging_duration_histogram = Histogram('charging_session_duration_seconds', 'Duration of charging sessions',
                                         ['substation_id'])
 
+# Number of completed sessions retained for lookups
+SESSION_HISTORY_SIZE = 1024
+
+# Shared HTTP session for completion callbacks to the load balancer. Callbacks are
+# idempotent on the load balancer side, so POSTs are retried with backoff (about
+# 30s in total) to ride out timeouts and brief load balancer restarts.
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=6, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=frozenset({'POST'}), raise_on_status=False)
+))
+
 
 # Substation state
 class SubstationState:
-    def __init__(self, substation_id, max_capacity=100):
+    def __init__(self, substation_id, max_capacity=100, completion_callback_url=None):
         self.substation_id = substation_id
+        self.completion_callback_url = completion_callback_url
         self.max_capacity = max_capacity  # kW
         self.current_load = 0  # kW
         self.active_sessions = {}
-        self.session_history = []
+        self.session_history = deque(maxlen=SESSION_HISTORY_SIZE)
+        self._completed_by_id = OrderedDict()
         self.lock = threading.Lock()
 
-        # Initialize Prometheus metrics
-        substation_load_gauge.labels(substation_id=self.substation_id).set(0)
+        # /status body, rebuilt only after the load changes
+        self._inv_max_capacity_times_100 = 100.0 / self.max_capacity
+        self._status_bytes = None
+        self._status_dirty = True
+
+        # Pending session completions as (end_time, session_id), drained by a single timer thread
+        self._timer_heap = []
+        self._timer_cv = threading.Condition()
+        threading.Thread(target=self._timer_loop, daemon=True).start()
+
+        # Completion callbacks are posted off the timer thread so a slow receiver can't delay completions
+        self._callback_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='completion-callback')
+
+        # Initialize Prometheus metrics, keeping the labelled children to skip per-call label lookups
+        self._load_child = substation_load_gauge.labels(substation_id=self.substation_id)
+        self._started_counter = charging_sessions_counter.labels(substation_id=self.substation_id, status='started')
+        self._completed_counter = charging_sessions_counter.labels(substation_id=self.substation_id,
+                                                                   status='completed')
+        self._duration_child = charging_duration_histogram.labels(substation_id=self.substation_id)
+        self._load_child.set(0)
+        self._last_reported_load = 0
         substation_capacity_gauge.labels(substation_id=self.substation_id).set(self.max_capacity)
 
     def can_accept_load(self, requested_power):
         with self.lock:
             return (self.current_load + requested_power) <= self.max_capacity
 
-    def add_charging_session(self, vehicle_id, requested_power, duration):
-        # with self.lock:
-        if not self.can_accept_load(requested_power):
-            return None
+    def add_charging_session(self, vehicle_id, requested_power, duration, request_id=None):
         session_id = str(uuid.uuid4())
         session = {
             'session_id': session_id,
+            'request_id': request_id,
             'vehicle_id': vehicle_id,
             'power': requested_power,
             'duration': duration,
-            'start_time': datetime.now(timezone.utc),
+            'start_time': time.time(),
+            'start_monotonic': time.monotonic(),
             'status': 'active'
         }
-        self.active_sessions[session_id] = session
-        self.current_load += requested_power
-        substation_load_gauge.labels(substation_id=self.substation_id).set(self.current_load)
-        charging_sessions_counter.labels(substation_id=self.substation_id, status='started').inc()
-        threading.Thread(target=self._complete_charging, args=(session_id,), daemon=True).start()
+        with self.lock:
+            if (self.current_load + requested_power) > self.max_capacity:
+                return None
+            self.active_sessions[session_id] = session
+            self.current_load += requested_power
+            self._status_dirty = True
+            self._report_load()
+        self._started_counter.inc()
+        with self._timer_cv:
+            heapq.heappush(self._timer_heap, (time.monotonic() + duration, session_id))
+            self._timer_cv.notify()
         logger.info(f"Started charging session {session_id} for vehicle {vehicle_id}")
         return session
 
+    def _report_load(self):
+        # Called with self.lock held
+        if self.current_load != self._last_reported_load:
+            self._load_child.set(self.current_load)
+            self._last_reported_load = self.current_load
+
+    def _timer_loop(self):
+        while True:
+            with self._timer_cv:
+                while True:
+                    now = time.monotonic()
+                    if self._timer_heap and self._timer_heap[0][0] <= now:
+                        break
+                    timeout = self._timer_heap[0][0] - now if self._timer_heap else None
+                    self._timer_cv.wait(timeout)
+                expired = []
+                while self._timer_heap and self._timer_heap[0][0] <= now:
+                    expired.append(heapq.heappop(self._timer_heap)[1])
+            for session_id in expired:
+                try:
+                    self._complete_charging(session_id)
+                except Exception as e:
+                    logger.error(f"Error completing charging session {session_id}: {e}")
+
     def _complete_charging(self, session_id):
-        if session_id in self.active_sessions:
-            session = self.active_sessions[session_id]
-            time.sleep(session['duration'])
-            # with self.lock:
-            if session_id in self.active_sessions:
-                session['end_time'] = datetime.now(timezone.utc)
-                session['status'] = 'completed'
-                self.current_load -= session['power']
-                self.session_history.append(session)
-                del self.active_sessions[session_id]
-                substation_load_gauge.labels(substation_id=self.substation_id).set(self.current_load)
-                charging_sessions_counter.labels(substation_id=self.substation_id, status='completed').inc()
-                duration_seconds = (session['end_time'] - session['start_time']).total_seconds()
-                charging_duration_histogram.labels(substation_id=self.substation_id).observe(duration_seconds)
-                logger.info(f"Completed charging session {session_id}")
-
-    def get_status(self):
-        # with self.lock:
+        with self.lock:
+            session = self.active_sessions.get(session_id)
+            if session is None:
+                return
+            session['end_time'] = time.time()
+            session['status'] = 'completed'
+            self.current_load -= session['power']
+            self._status_dirty = True
+            self.session_history.append(session)
+            self._completed_by_id[session_id] = session
+            if len(self._completed_by_id) > SESSION_HISTORY_SIZE:
+                self._completed_by_id.popitem(last=False)
+            del self.active_sessions[session_id]
+            self._report_load()
+        self._completed_counter.inc()
+        duration_seconds = time.monotonic() - session['start_monotonic']
+        self._duration_child.observe(duration_seconds)
+        logger.info(f"Completed charging session {session_id}")
+        # Sessions started directly on this substation have no load balancer request to complete
+        if self.completion_callback_url and session['request_id']:
+            self._callback_pool.submit(self._notify_completion, session)
+
+    def _notify_completion(self, session):
+        try:
+            response = http_session.post(
+                self.completion_callback_url,
+                data=orjson.dumps({
+                    'request_id': session['request_id'],
+                    'session_id': session['session_id'],
+                    'substation_id': self.substation_id,
+                    'session': format_session(session)
+                }),
+                headers={'Content-Type': 'application/json'},
+                timeout=2
+            )
+            if not response.ok:
+                logger.warning(f"Completion callback for session {session['session_id']} "
+                               f"returned {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Failed to send completion callback for session {session['session_id']}: {e}")
+
+    def get_status_json(self):
+        with self.lock:
+            if self._status_dirty:
+                self._status_bytes = orjson.dumps(self._build_status())
+                self._status_dirty = False
+            return self._status_bytes
+
+    def _build_status(self):
+        # Called with self.lock held
+        current_load = self.current_load
         return {
                 'substation_id': self.substation_id,
-                'current_load': self.current_load,
+                'current_load': current_load,
                 'max_capacity': self.max_capacity,
-                'utilization_percent': (self.current_load / self.max_capacity) * 100,
+                'utilization_percent': 0.0 if current_load == 0 else current_load * self._inv_max_capacity_times_100,
                 'active_sessions': len(self.active_sessions),
-                'available_capacity': self.max_capacity - self.current_load
+                'available_capacity': self.max_capacity - current_load
         }
 
-
 import os
 
 SUBSTATION_ID = os.getenv('SUBSTATION_ID', f'substation-{random.randint(1000, 9999)}')
 MAX_CAPACITY = int(os.getenv('MAX_CAPACITY', '100'))
-substation = SubstationState(SUBSTATION_ID, MAX_CAPACITY)
+COMPLETION_CALLBACK_URL = os.getenv('COMPLETION_CALLBACK_URL', '')
+if not COMPLETION_CALLBACK_URL:
+    logger.warning("COMPLETION_CALLBACK_URL is not set; the load balancer will not be told "
+                   "when charging sessions complete")
+substation = SubstationState(SUBSTATION_ID, MAX_CAPACITY, COMPLETION_CALLBACK_URL)
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "substation_id": SUBSTATION_ID}), 200
+    return ojsonify({"status": "healthy", "substation_id": SUBSTATION_ID}, 200)
 
 
 @app.route('/status', methods=['GET'])
 def get_status():
-    return jsonify(substation.get_status()), 200
+    return app.response_class(substation.get_status_json(), status=200, mimetype='application/json')
 
 
 @app.route('/charge', methods=['POST'])
@@ -115,54 +237,57 @@ def start_charging():
     try:
         data = request.get_json()
         if not substation.can_accept_load(data['requested_power']):
-            return jsonify({
+            return ojsonify({
                 "error": "Insufficient capacity",
                 "current_load": substation.current_load,
                 "max_capacity": substation.max_capacity,
                 "requested_power": data['requested_power']
-            }), 409
+            }, 409)
 
         # Start charging session
         session = substation.add_charging_session(
             data['vehicle_id'],
             data['requested_power'],
-            data['duration']
+            data['duration'],
+            data.get('request_id')
         )
 
         if session:
-            return jsonify({
+            return ojsonify({
                 "status": "charging_started",
                 "session_id": session['session_id'],
                 "substation_id": SUBSTATION_ID,
-                "estimated_completion": (session['start_time'] +
-                                         datetime.timedelta(seconds=session['duration'])).isoformat()
-            }), 200
+                "estimated_completion": (datetime.fromtimestamp(session['start_time'], tz=timezone.utc) +
+                                         timedelta(seconds=session['duration'])).isoformat()
+            }, 200)
         else:
-            return jsonify({"error": "Failed to start charging session"}), 500
+            return ojsonify({"error": "Failed to start charging session"}, 500)
 
     except Exception as e:
         logger.error(f"Error starting charging session: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
+        return ojsonify({"error": "Internal server error"}, 500)
 
 
 @app.route('/sessions', methods=['GET'])
 def list_sessions():
     with substation.lock:
-        return jsonify({
-            "active_sessions": list(substation.active_sessions.values()),
-            "completed_sessions": substation.session_history[-10:]  # Last 10 completed
-        }), 200
+        return ojsonify({
+            "active_sessions": [format_session(session) for session in substation.active_sessions.values()],
+            "completed_sessions": [format_session(session) for session in itertools.islice(
+                substation.session_history, max(0, len(substation.session_history) - 10), None
+            )]  # Last 10 completed
+        }, 200)
 
 
 @app.route('/sessions/<session_id>', methods=['GET'])
 def get_session(session_id):
     with substation.lock:
         if session_id in substation.active_sessions:
-            return jsonify(substation.active_sessions[session_id]), 200
-        for session in substation.session_history:
-            if session['session_id'] == session_id:
-                return jsonify(session), 200
-        return jsonify({"error": "Session not found"}), 404
+            return ojsonify(format_session(substation.active_sessions[session_id]), 200)
+        session = substation._completed_by_id.get(session_id)
+        if session is not None:
+            return ojsonify(format_session(session), 200)
+        return ojsonify({"error": "Session not found"}, 404)
 
 
 if __name__ == '__main__':
@@ -1,35 +1,88 @@
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import math
 import random
 import threading
-import json
+import re
+import array
+import orjson
 import uuid
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 import argparse
 import os
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('load_test.log')
-    ]
-)
+from collections import Counter
+import numpy as np
+
+# Configure logging: worker threads only enqueue records, a listener thread does the I/O
+log_queue = queue.Queue(-1)
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [logging.StreamHandler(), logging.FileHandler('load_test.log')]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
+# Log one in every N successful requests per worker thread
+SUCCESS_LOG_SAMPLE = 256
+
+# Default connection pool size when no target rate is known up front
+POOL_SIZE = 64
+
+# Worker pool sizing (Little's law): rate * worst-case latency * safety margin
+MIN_WORKERS = 20
+ASSUMED_LATENCY_S = 2.0
+WORKER_SAFETY_FACTOR = 1.5
+
+# Resolution of the precomputed rush hour rate table
+RATE_TICKS_PER_SEC = 10
+
+# Number of pre-serialized vehicle payloads requests are drawn from
+PAYLOAD_POOL_SIZE = 10_000
+
+# Number of random draws generated per batch for vehicle data
+RNG_BATCH_SIZE = 10_000
+
+VEHICLE_TYPES = [
+    {'type': 'compact', 'power_range': (7, 22), 'duration_range': (1800, 3600)},  # 30min-1hr
+    {'type': 'sedan', 'power_range': (11, 43), 'duration_range': (2400, 4800)},   # 40min-1.3hr
+    {'type': 'suv', 'power_range': (22, 50), 'duration_range': (3000, 5400)},     # 50min-1.5hr
+    {'type': 'truck', 'power_range': (50, 150), 'duration_range': (3600, 7200)},  # 1hr-2hr
+]
+
+# Pulls request_id out of a charge response without decoding the whole body
+_RID_RE = re.compile(rb'"request_id"\s*:\s*"([^"]+)"')
+
+def workers_for_rate(rps):
+    """Number of concurrent workers needed to sustain rps requests per second"""
+    return max(MIN_WORKERS, math.ceil(rps * ASSUMED_LATENCY_S * WORKER_SAFETY_FACTOR))
+
 class LoadTester:
-    def __init__(self, base_url="http://localhost:5001"):
+    def __init__(self, base_url="http://localhost:5001", record_active=False, pool_size=POOL_SIZE):
         self.base_url = base_url
+        # Keep a record of every accepted request in self.active_requests
+        self.record_active = record_active
+        self.pool_size = pool_size
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
         self.results = {
             'total_requests': 0,
             'successful_requests': 0,
             'failed_requests': 0,
-            'response_times': [],
+            'response_times': array.array('d'),
             'errors': [],
             'start_time': None,
             'end_time': None
@@ -37,92 +90,219 @@ class LoadTester:
         self.active_requests = []
         self.lock = threading.Lock()
 
+        # Batched random draws consumed by generate_vehicle_data
+        self._rng = np.random.default_rng()
+        self._refill_random()
+
+        # Pre-serialized (payload, vehicle_id) pairs so request emission does no generation or encoding
+        self._url = f"{base_url}/api/charge"
+        self._json_headers = {'Content-Type': 'application/json'}
+        self._payload_pool = []
+        for _ in range(PAYLOAD_POOL_SIZE):
+            vehicle_data = self.generate_vehicle_data()
+            self._payload_pool.append((orjson.dumps(vehicle_data), vehicle_data['vehicle_id']))
+
+        # Per-thread result buffers, merged into self.results once a test finishes
+        self._tls = threading.local()
+        self._all_buffers = []
+
+    def warm_up(self, connections=None):
+        """Open pooled connections ahead of the test with concurrent health checks"""
+        connections = connections or self.pool_size
+        def ping():
+            try:
+                self.session.get(f"{self.base_url}/health", timeout=5)
+            except requests.exceptions.RequestException:
+                pass
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for _ in range(connections):
+                executor.submit(ping)
+        logger.info(f"Warmed up {connections} connections")
+
+    def _refill_random(self):
+        """Draw the next batch of random values for generate_vehicle_data"""
+        rng, n = self._rng, RNG_BATCH_SIZE
+        self._vehicle_type_idx = rng.integers(0, len(VEHICLE_TYPES), size=n).tolist()
+        self._power_u = rng.random(n).tolist()
+        self._duration_u = rng.random(n).tolist()
+        self._vehicle_num = rng.integers(1000, 10000, size=n).tolist()
+        self._owner_num = rng.integers(100, 1000, size=n).tolist()
+        self._battery_level = rng.integers(10, 91, size=n).tolist()
+        self._target_level = rng.integers(80, 101, size=n).tolist()
+        self._ix = 0
+
     def generate_vehicle_data(self):
         """Generate realistic vehicle charging data"""
-        vehicle_types = [
-            {'type': 'compact', 'power_range': (7, 22), 'duration_range': (1800, 3600)},  # 30min-1hr
-            {'type': 'sedan', 'power_range': (11, 43), 'duration_range': (2400, 4800)},   # 40min-1.3hr
-            {'type': 'suv', 'power_range': (22, 50), 'duration_range': (3000, 5400)},     # 50min-1.5hr
-            {'type': 'truck', 'power_range': (50, 150), 'duration_range': (3600, 7200)},  # 1hr-2hr
-        ]
+        if self._ix == RNG_BATCH_SIZE:
+            self._refill_random()
+        i = self._ix
+        self._ix += 1
 
-        vehicle_type = random.choice(vehicle_types)
-        power = random.uniform(*vehicle_type['power_range'])
-        duration = random.randint(*vehicle_type['duration_range'])
+        vehicle_type = VEHICLE_TYPES[self._vehicle_type_idx[i]]
+        power_lo, power_hi = vehicle_type['power_range']
+        duration_lo, duration_hi = vehicle_type['duration_range']
+        power = power_lo + self._power_u[i] * (power_hi - power_lo)
+        duration = duration_lo + int(self._duration_u[i] * (duration_hi - duration_lo + 1))
 
         return {
-            'vehicle_id': f"EV-{random.randint(1000, 9999)}",
+            'vehicle_id': f"EV-{self._vehicle_num[i]}",
             'vehicle_type': vehicle_type['type'],
             'requested_power': round(power, 2),
             'duration': duration,
-            'owner_id': f"user-{random.randint(100, 999)}",
-            'battery_level': random.randint(10, 90),
-            'target_level': random.randint(80, 100)
+            'owner_id': f"user-{self._owner_num[i]}",
+            'battery_level': self._battery_level[i],
+            'target_level': self._target_level[i]
         }
 
-    def send_charge_request(self, vehicle_data):
-        """Send a single charge request"""
-        start_time = time.time()
-
+    def _buffer(self):
+        """Return the calling thread's result buffer, registering it on first use"""
+        buffer = getattr(self._tls, 'buffer', None)
+        if buffer is None:
+            buffer = {'response_times': array.array('d'), 'active': [], 'errors': [], 'ok': 0, 'fail': 0}
+            self._tls.buffer = buffer
+            with self.lock:
+                self._all_buffers.append(buffer)
+        return buffer
+
+    def _completed_count(self):
+        """Requests finished so far, including those not yet merged"""
+        return self.results['total_requests'] + sum(b['ok'] + b['fail'] for b in list(self._all_buffers))
+
+    def merge_results(self):
+        """Fold all per-thread buffers into self.results"""
+        with self.lock:
+            buffers, self._all_buffers = self._all_buffers, []
+        for buffer in buffers:
+            self.results['total_requests'] += buffer['ok'] + buffer['fail']
+            self.results['successful_requests'] += buffer['ok']
+            self.results['failed_requests'] += buffer['fail']
+            self.results['response_times'].extend(buffer['response_times'])
+            self.results['errors'].extend(buffer['errors'])
+            self.active_requests.extend(buffer['active'])
+        # Threads that outlive this merge start a fresh buffer
+        self._tls = threading.local()
+
+    def send_charge_request(self, payload, vehicle_id):
+        """Send a single charge request with a pre-serialized JSON payload"""
+        start_time = time.perf_counter()
         try:
             response = self.session.post(
-                f"{self.base_url}/api/charge",
-                json=vehicle_data,
+                self._url,
+                data=payload,
+                headers=self._json_headers,
                 timeout=30
             )
-
-            end_time = time.time()
-            response_time = end_time - start_time
-
-            with self.lock:
-                self.results['total_requests'] += 1
-                self.results['response_times'].append(response_time)
-
-                if response.status_code == 200:
-                    self.results['successful_requests'] += 1
-                    result = response.json()
-                    self.active_requests.append({
-                        'request_id': result.get('request_id'),
-                        'vehicle_id': vehicle_data['vehicle_id'],
-                        'status': 'submitted',
-                        'response_time': response_time,
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    logger.info(f"✓ Request successful for {vehicle_data['vehicle_id']} "
-                              f"({response_time:.2f}s)")
-                else:
-                    self.results['failed_requests'] += 1
-                    error_info = {
-                        'vehicle_id': vehicle_data['vehicle_id'],
-                        'status_code': response.status_code,
-                        'error': response.text,
-                        'response_time': response_time
-                    }
-                    self.results['errors'].append(error_info)
-                    logger.warning(f"✗ Request failed for {vehicle_data['vehicle_id']}: "
-                                 f"{response.status_code} - {response.text}")
-
-            return response.status_code == 200
-
         except Exception as e:
-            end_time = time.time()
-            response_time = end_time - start_time
-
-            with self.lock:
-                self.results['total_requests'] += 1
-                self.results['failed_requests'] += 1
-                self.results['response_times'].append(response_time)
-
-                error_info = {
-                    'vehicle_id': vehicle_data['vehicle_id'],
-                    'error': str(e),
-                    'response_time': response_time
-                }
-                self.results['errors'].append(error_info)
-                logger.error(f"✗ Exception for {vehicle_data['vehicle_id']}: {e}")
-
+            response, error = None, e
+        response_time = time.perf_counter() - start_time
+
+        buffer = self._buffer()
+        buffer['response_times'].append(response_time)
+
+        if response is None:
+            buffer['fail'] += 1
+            error_info = {
+                'vehicle_id': vehicle_id,
+                'error': str(error),
+                'response_time': response_time
+            }
+            buffer['errors'].append(error_info)
+            logger.error(f"✗ Exception for {vehicle_id}: {error}")
             return False
 
+        if response.status_code == 200:
+            buffer['ok'] += 1
+            if self.record_active:
+                match = _RID_RE.search(response.content)
+                buffer['active'].append({
+                    'request_id': match.group(1).decode() if match else None,
+                    'vehicle_id': vehicle_id,
+                    'status': 'submitted',
+                    'response_time': response_time,
+                    'timestamp': datetime.now().isoformat()
+                })
+            if buffer['ok'] % SUCCESS_LOG_SAMPLE == 1:
+                logger.info(f"✓ Request successful for {vehicle_id} "
+                          f"({response_time:.2f}s)")
+            return True
+
+        buffer['fail'] += 1
+        error_info = {
+            'vehicle_id': vehicle_id,
+            'status_code': response.status_code,
+            'error': response.text,
+            'response_time': response_time
+        }
+        buffer['errors'].append(error_info)
+        logger.warning(f"✗ Request failed for {vehicle_id}: "
+                     f"{response.status_code} - {response.text}")
+        return False
+
+    def _report_failures(self, done):
+        """Surface exceptions raised by finished request futures"""
+        for future in done:
+            error = future.exception()
+            if error is not None:
+                logger.error(f"Request execution error: {error}")
+
+    def _run_schedule(self, max_workers, total_duration, get_request_rate):
+        """Submit requests at the rate given by get_request_rate(elapsed) until they all finish
+
+        Uses a monotonic token bucket: every request owed since the last pass is
+        submitted before sleeping until the next one is due, so submit overhead and
+        sleep granularity don't drag the emitted rate below target.
+
+        At most 2*max_workers futures are held at once; results are already recorded
+        in the thread-local buffers, so finished futures are simply dropped.
+        """
+        logger.info(f"Using {max_workers} worker threads")
+        if max_workers > self.pool_size:
+            logger.warning(f"Worker count {max_workers} exceeds connection pool size {self.pool_size}")
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        max_in_flight = 2 * max_workers
+        in_flight = set()
+        start_time = time.monotonic()
+        next_due = start_time
+        next_progress = start_time
+
+        while True:
+            now = time.monotonic()
+            elapsed = now - start_time
+            if elapsed >= total_duration:
+                break
+
+            current_rate = get_request_rate(elapsed)
+            if current_rate > 0:
+                interval = 1.0 / current_rate
+                while next_due <= now:
+                    payload, vehicle_id = random.choice(self._payload_pool)
+                    in_flight.add(executor.submit(self.send_charge_request, payload, vehicle_id))
+                    if len(in_flight) > max_in_flight:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        self._report_failures(done)
+                    next_due += interval
+                # Don't let a long interval from an earlier, lower rate delay a ramp-up
+                next_due = min(next_due, now + interval)
+            else:
+                next_due = now + 0.1
+
+            # Log progress every 30 seconds
+            if now >= next_progress:
+                logger.info(f"Progress: {elapsed/60:.1f}min, "
+                          f"Rate: {current_rate:.1f} req/s, "
+                          f"Submitted: {self._completed_count()}")
+                next_progress += 30
+
+            # Wake at least every 100ms so rate changes are picked up promptly
+            wake_at = min(next_due, now + 0.1, start_time + total_duration)
+            time.sleep(max(0.0, wake_at - time.monotonic()))
+
+        # Wait for all requests to complete
+        logger.info("Waiting for all requests to complete...")
+        executor.shutdown(wait=True)
+        self._report_failures(in_flight)
+
     def rush_hour_simulation(self, duration_minutes=10, peak_rps=10):
         """Simulate rush hour traffic with gradual increase and decrease"""
         logger.info(f"Starting rush hour simulation for {duration_minutes} minutes")
@@ -131,54 +311,21 @@ class LoadTester:
         self.results['start_time'] = datetime.now()
         total_duration = duration_minutes * 60  # Convert to seconds
 
-        # Rush hour pattern: gradual increase, peak, gradual decrease
+        # Rush hour pattern: gradual increase, peak, gradual decrease,
+        # precomputed per tick so the scheduler only does a list lookup
+        ticks = max(1, int(total_duration * RATE_TICKS_PER_SEC))
+        progress = np.arange(ticks) / ticks
+        rates = np.where(progress < 0.3, peak_rps * (progress / 0.3),        # First 30% - gradual increase
+                np.where(progress < 0.7, peak_rps,                            # Middle 40% - peak traffic
+                         peak_rps * (1 - (progress - 0.7) / 0.3))).tolist()   # Last 30% - gradual decrease
+
         def get_request_rate(elapsed_time):
-            """Calculate request rate based on elapsed time (rush hour pattern)"""
-            progress = elapsed_time / total_duration
-
-            if progress < 0.3:  # First 30% - gradual increase
-                return peak_rps * (progress / 0.3)
-            elif progress < 0.7:  # Middle 40% - peak traffic
-                return peak_rps
-            else:  # Last 30% - gradual decrease
-                return peak_rps * (1 - (progress - 0.7) / 0.3)
-
-        start_time = time.time()
-
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            futures = []
-
-            while time.time() - start_time < total_duration:
-                elapsed = time.time() - start_time
-                current_rate = get_request_rate(elapsed)
-
-                # Calculate sleep time for current rate
-                if current_rate > 0:
-                    sleep_time = 1.0 / current_rate
-
-                    # Generate and submit request
-                    vehicle_data = self.generate_vehicle_data()
-                    future = executor.submit(self.send_charge_request, vehicle_data)
-                    futures.append(future)
-
-                    # Log progress every 30 seconds
-                    if int(elapsed) % 30 == 0:
-                        logger.info(f"Progress: {elapsed/60:.1f}min, "
-                                  f"Rate: {current_rate:.1f} req/s, "
-                                  f"Submitted: {self.results['total_requests']}")
-
-                    time.sleep(sleep_time)
-                else:
-                    time.sleep(1)
-
-            # Wait for all requests to complete
-            logger.info("Waiting for all requests to complete...")
-            for future in as_completed(futures, timeout=60):
-                try:
-                    future.result()
-                except Exception as e:
-                    logger.error(f"Request execution error: {e}")
+            """Look up the request rate for the elapsed time (rush hour pattern)"""
+            return rates[min(int(elapsed_time * RATE_TICKS_PER_SEC), ticks - 1)]
+
+        self._run_schedule(workers_for_rate(peak_rps), total_duration, get_request_rate)
 
+        self.merge_results()
         self.results['end_time'] = datetime.now()
         logger.info("Rush hour simulation completed")
 
@@ -188,32 +335,10 @@ class LoadTester:
 
         self.results['start_time'] = datetime.now()
         total_duration = duration_minutes * 60
-        sleep_time = 1.0 / rps
-
-        start_time = time.time()
-
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            futures = []
 
-            while time.time() - start_time < total_duration:
-                vehicle_data = self.generate_vehicle_data()
-                future = executor.submit(self.send_charge_request, vehicle_data)
-                futures.append(future)
-
-                elapsed = time.time() - start_time
-                if int(elapsed) % 30 == 0:
-                    logger.info(f"Progress: {elapsed/60:.1f}min, "
-                              f"Submitted: {self.results['total_requests']}")
-
-                time.sleep(sleep_time)
-
-            # Wait for completion
-            for future in as_completed(futures, timeout=60):
-                try:
-                    future.result()
-                except Exception as e:
-                    logger.error(f"Request execution error: {e}")
+        self._run_schedule(workers_for_rate(rps), total_duration, lambda elapsed: rps)
 
+        self.merge_results()
         self.results['end_time'] = datetime.now()
         logger.info("Sustained load test completed")
 
@@ -222,26 +347,10 @@ class LoadTester:
         logger.info(f"Starting spike test: {spike_rps} RPS for {spike_duration} seconds")
 
         self.results['start_time'] = datetime.now()
-        sleep_time = 1.0 / spike_rps
-
-        start_time = time.time()
 
-        with ThreadPoolExecutor(max_workers=30) as executor:
-            futures = []
-
-            while time.time() - start_time < spike_duration:
-                vehicle_data = self.generate_vehicle_data()
-                future = executor.submit(self.send_charge_request, vehicle_data)
-                futures.append(future)
-                time.sleep(sleep_time)
-
-            # Wait for completion
-            for future in as_completed(futures, timeout=60):
-                try:
-                    future.result()
-                except Exception as e:
-                    logger.error(f"Request execution error: {e}")
+        self._run_schedule(workers_for_rate(spike_rps), spike_duration, lambda elapsed: spike_rps)
 
+        self.merge_results()
         self.results['end_time'] = datetime.now()
         logger.info("Spike test completed")
 
@@ -251,7 +360,7 @@ class LoadTester:
             logger.error("No data to analyze")
             return
 
-        response_times = self.results['response_times']
+        response_times = np.frombuffer(self.results['response_times'], dtype=np.float64)
 
         print("" + "="*60)
         print("LOAD TEST RESULTS SUMMARY")
@@ -264,23 +373,20 @@ class LoadTester:
         print()
 
         print("RESPONSE TIME STATISTICS:")
-        print(f"Average: {sum(response_times)/len(response_times):.3f}s")
-        print(f"Min: {min(response_times):.3f}s")
-        print(f"Max: {max(response_times):.3f}s")
-
-        sorted_times = sorted(response_times)
-        print(f"P50: {sorted_times[len(sorted_times)//2]:.3f}s")
-        print(f"P90: {sorted_times[int(len(sorted_times)*0.9)]:.3f}s")
-        print(f"P95: {sorted_times[int(len(sorted_times)*0.95)]:.3f}s")
-        print(f"P99: {sorted_times[int(len(sorted_times)*0.99)]:.3f}s")
+        print(f"Average: {response_times.mean():.3f}s")
+        print(f"Min: {response_times.min():.3f}s")
+        print(f"Max: {response_times.max():.3f}s")
+
+        p50, p90, p95, p99 = np.percentile(response_times, [50, 90, 95, 99])
+        print(f"P50: {p50:.3f}s")
+        print(f"P90: {p90:.3f}s")
+        print(f"P95: {p95:.3f}s")
+        print(f"P99: {p99:.3f}s")
         print()
 
         if self.results['errors']:
             print("ERROR SUMMARY:")
-            error_types = {}
-            for error in self.results['errors']:
-                error_key = error.get('status_code', 'Exception')
-                error_types[error_key] = error_types.get(error_key, 0) + 1
+            error_types = Counter(error.get('status_code', 'Exception') for error in self.results['errors'])
 
             for error_type, count in error_types.items():
                 print(f"  {error_type}: {count} occurrences")
@@ -289,18 +395,19 @@ class LoadTester:
 
     def save_results(self, filename="load_test_results.json"):
         """Save results to JSON file"""
-        # Convert datetime objects to strings for JSON serialization
-        results_copy = self.results.copy()
-        if results_copy['start_time']:
-            results_copy['start_time'] = results_copy['start_time'].isoformat()
-        if results_copy['end_time']:
-            results_copy['end_time'] = results_copy['end_time'].isoformat()
-
-        with open(filename, 'w') as f:
-            json.dump(results_copy, f, indent=2)
+        # orjson serializes the datetimes itself, so no copy of the results is needed
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(self.results, default=_json_default,
+                                 option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
         logger.info(f"Results saved to {filename}")
 
+def _json_default(obj):
+    """Serialize response time arrays as NumPy views; anything else as its string form"""
+    if isinstance(obj, array.array):
+        return np.frombuffer(obj, dtype=np.float64)
+    return str(obj)
+
 def main():
     parser = argparse.ArgumentParser(description='Smart Grid Load Tester')
     parser.add_argument('--url', default='http://localhost:5001', 
@@ -325,7 +432,10 @@ def main():
         return 1
     logger.info(f"Starting {args.test_type} load test")
     logger.info(f"Target URL: {args.url}")
-    tester = LoadTester(args.url)
+    pool_size = workers_for_rate(args.rps)
+    logger.info(f"Worker and connection pool size: {pool_size}")
+    tester = LoadTester(args.url, pool_size=pool_size)
+    tester.warm_up()
     try:
         if args.test_type == 'rush-hour':
             tester.rush_hour_simulation(args.duration, args.rps)
@@ -339,6 +449,7 @@ def main():
         return 0
     except KeyboardInterrupt:
         logger.info("Load test interrupted by user")
+        tester.merge_results()
         tester.print_results()
         return 0
     except Exception as e: